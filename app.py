@@ -1,5 +1,11 @@
+from __future__ import annotations
+
 import os
+import sys
 import json
+import importlib
+import threading
+import hashlib
 import logging
 import re
 import tempfile
@@ -7,24 +13,39 @@ import uuid
 import time
 import asyncio
 import random
-from contextlib import asynccontextmanager
-from typing import Dict, Optional
+from contextlib import asynccontextmanager, contextmanager
+from typing import Awaitable, Callable, Dict, Optional
 from collections import defaultdict
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+_BOOT_START = time.perf_counter()
 
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks, Request
+from fastapi import FastAPI, UploadFile, File, BackgroundTasks, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
-from pydantic import BaseModel, validator
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ValidationError, validator
 from starlette.middleware.base import BaseHTTPMiddleware
-import aiohttp
-import edge_tts
+from starlette.requests import HTTPConnection
+
+class _LazyModule:
+    """Importa el módulo real en el primer acceso a un atributo (acelera el arranque de cada worker)."""
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr):
+        # Solo se llama para atributos aún no resueltos; después se leen directo de la instancia
+        value = getattr(importlib.import_module(self._name), attr)
+        setattr(self, attr, value)
+        return value
 
-from supabase import create_client, Client
+aiohttp = _LazyModule("aiohttp")
+edge_tts = _LazyModule("edge_tts")
 
-REDIS_AVAILABLE = False
+PROMETHEUS_AVAILABLE = False
 try:
-    import redis.asyncio as aioredis
-    REDIS_AVAILABLE = True
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+    PROMETHEUS_AVAILABLE = True
 except ImportError:
     pass
 
@@ -42,15 +63,16 @@ REDIS_URL          = os.getenv("REDIS_URL", "")
 SUPABASE_URL = os.getenv("VITE_SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", os.getenv("VITE_SUPABASE_ANON_KEY", ""))
 
-if SUPABASE_URL and SUPABASE_KEY:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-    logging.info("✅ Cliente Supabase inicializado correctamente.")
-else:
-    supabase = None
+SUPABASE_ENABLED = bool(SUPABASE_URL and SUPABASE_KEY)
+if not SUPABASE_ENABLED:
     logging.warning("⚠️ Credenciales de Supabase no encontradas. El historial no se guardará.")
 
 MODEL_NAME     = os.getenv("MODEL_NAME", "google/gemini-2.5-flash-lite")
-OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+EXAM_MODEL_NAME = "meta-llama/llama-3.1-8b-instruct"
+# Sobrescribibles para apuntar a los servicios simulados de bench/
+OPENROUTER_URL    = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+DEEPGRAM_URL      = os.getenv("DEEPGRAM_URL", "https://api.deepgram.com/v1/listen?model=nova-2&smart_format=true&language=es")
+DEEPGRAM_LIVE_URL = os.getenv("DEEPGRAM_LIVE_URL", "wss://api.deepgram.com/v1/listen?model=nova-2&smart_format=true&language=es&interim_results=true")
 
 # Raava es el único mentor
 RAAVA_VOICE       = "es-MX-DaliaNeural"
@@ -78,15 +100,67 @@ RATE_LISTEN    = int(os.getenv("RATE_LISTEN", "15"))
 RATE_TALK      = int(os.getenv("RATE_TALK", "20"))
 RATE_INIT      = int(os.getenv("RATE_INIT", "10"))
 RATE_EXAM      = int(os.getenv("RATE_EXAM", "10"))
+RATE_VOICE     = int(os.getenv("RATE_VOICE", "20"))
 RATE_GENERAL   = int(os.getenv("RATE_GENERAL", "60"))
 MAX_SESSIONS   = int(os.getenv("MAX_SESSIONS", "5000"))
 MAX_HISTORY    = int(os.getenv("MAX_HISTORY", "30"))
 SESSION_TTL    = int(os.getenv("SESSION_TTL", "3600"))
 MAX_MSG_LEN    = int(os.getenv("MAX_MSG_LEN", "2000"))
 MAX_AUDIO_SIZE = int(os.getenv("MAX_AUDIO_SIZE", str(10 * 1024 * 1024)))
+EXAM_WORKERS   = int(os.getenv("EXAM_WORKERS", "4"))
+EXAM_QUEUE_MAX = int(os.getenv("EXAM_QUEUE_MAX", "100"))
+EXAM_JOB_TTL   = int(os.getenv("EXAM_JOB_TTL", "3600"))
+# Un job en curso sin cambiar de etapa durante este tiempo se da por abandonado
+EXAM_JOB_STALE = int(os.getenv("EXAM_JOB_STALE", "600"))
+# Un job en cola solo se pierde si el proceso se reinicia; el límite cubre la
+# peor espera legítima: la cola llena con cada job agotando el timeout de 90 s.
+EXAM_JOB_QUEUE_STALE = int(os.getenv("EXAM_JOB_QUEUE_STALE", str((EXAM_QUEUE_MAX // max(1, EXAM_WORKERS) + 1) * 90 + EXAM_JOB_STALE)))
+
+# Pool de preguntas pre-generadas por (topic_id, dificultad)
+EXAM_POOL_TARGET       = int(os.getenv("EXAM_POOL_TARGET", "30"))
+EXAM_POOL_BATCH        = int(os.getenv("EXAM_POOL_BATCH", "10"))
+EXAM_POOL_TOPICS       = int(os.getenv("EXAM_POOL_TOPICS", "20"))
+EXAM_POPULARITY_MAX    = int(os.getenv("EXAM_POPULARITY_MAX", "500"))  # (tema, dificultad) retenidos por día
+# Tokens/día para todo el despliegue, 0 desactiva el warmer. Requiere Redis: sin él cada worker
+# tendría su propio pool y gastaría el presupuesto completo.
+EXAM_POOL_TOKEN_BUDGET = int(os.getenv("EXAM_POOL_TOKEN_BUDGET", "200000"))
+EXAM_POOL_OFFPEAK      = os.getenv("EXAM_POOL_OFFPEAK", "22-6")  # horas "inicio-fin" en EXAM_POOL_TZ; vacío = siempre
+EXAM_POOL_TZ           = os.getenv("EXAM_POOL_TZ", "America/Mexico_City")  # zona de los alumnos, no la del contenedor
+EXAM_POOL_INTERVAL     = int(os.getenv("EXAM_POOL_INTERVAL", "900"))
+EXAM_POOL_TTL          = int(os.getenv("EXAM_POOL_TTL", str(7 * 24 * 3600)))
+
+# Si se define, /metrics exige "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN  = os.getenv("METRICS_TOKEN", "")
 
 redis_client = None
 
+_supabase_client = None
+_supabase_lock = threading.Lock()
+
+def preload_sdks() -> list:
+    """Carga los SDKs diferidos (bloqueante); devuelve [(ms, nombre)] para el reporte de arranque."""
+    timings = []
+    for name in ("aiohttp", "edge_tts"):
+        start = time.perf_counter()
+        importlib.import_module(name)
+        timings.append(((time.perf_counter() - start) * 1000, name))
+    if SUPABASE_ENABLED:
+        start = time.perf_counter()
+        get_supabase()
+        timings.append(((time.perf_counter() - start) * 1000, "supabase (cliente)"))
+    return timings
+
+def get_supabase():
+    """Crea el cliente de Supabase en el primer uso; es bloqueante, llamar desde asyncio.to_thread."""
+    global _supabase_client
+    if _supabase_client is None:
+        with _supabase_lock:
+            if _supabase_client is None:
+                from supabase import create_client
+                _supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
+                logging.info("✅ Cliente Supabase inicializado correctamente.")
+    return _supabase_client
+
 # Contador de tokens por usuario por día (en memoria, se resetea al reiniciar)
 token_counters: Dict[str, int] = defaultdict(int)
 
@@ -118,6 +192,294 @@ async def save_session(session_id: str, data: dict):
             logging.error(f"⚠️ Error guardando sesión en Redis: {e}. Usando fallback local.")
     sessions[session_id] = data
 
+# =============================================================================
+# EXAM JOBS (REDIS OR LOCAL)
+# =============================================================================
+
+exam_jobs: Dict[str, dict] = {}
+# Huella de la solicitud (usuario + parámetros) → job_id, para deduplicar envíos repetidos
+exam_job_dedup: Dict[str, str] = {}
+exam_queue: Optional[asyncio.Queue] = None
+
+async def get_exam_job(job_id: str) -> Optional[dict]:
+    global redis_client
+    if redis_client:
+        try:
+            val = await redis_client.get(f"examjob:{job_id}")
+            if val:
+                return json.loads(val)
+        except Exception as e:
+            logging.error(f"⚠️ Error leyendo job de Redis: {e}. Usando fallback local.")
+    return exam_jobs.get(job_id)
+
+async def save_exam_job(job_id: str, data: dict):
+    global redis_client
+    data["updated_at"] = time.time()
+    if redis_client:
+        try:
+            await redis_client.setex(f"examjob:{job_id}", EXAM_JOB_TTL, json.dumps(data))
+            return
+        except Exception as e:
+            logging.error(f"⚠️ Error guardando job en Redis: {e}. Usando fallback local.")
+    exam_jobs[job_id] = data
+
+def _job_pending(job: Optional[dict]) -> bool:
+    return bool(job) and job["status"] in ("queued", "running")
+
+async def load_exam_job(job_id: str) -> Optional[dict]:
+    """Como get_exam_job, pero da por fallido un job pendiente que nadie está procesando."""
+    job = await get_exam_job(job_id)
+    if _job_pending(job):
+        limit = EXAM_JOB_STALE if job["status"] == "running" else EXAM_JOB_QUEUE_STALE
+        if time.time() - job.get("updated_at", job["created_at"]) > limit:
+            await fail_exam_job(job, "Job abandonado, vuelve a intentarlo.", 503)
+    return job
+
+async def claim_exam_job(fingerprint: str, job_id: str) -> Optional[str]:
+    """Registra job_id para la huella; si ya hay un job en cola o en curso devuelve su id."""
+    global redis_client
+    if redis_client:
+        try:
+            key = f"examjob:dedup:{fingerprint}"
+            if await redis_client.set(key, job_id, nx=True, ex=EXAM_JOB_TTL):
+                return None
+            existing = await redis_client.get(key)
+            if existing and _job_pending(await load_exam_job(existing)):
+                return existing
+            await redis_client.set(key, job_id, ex=EXAM_JOB_TTL)
+            return None
+        except Exception as e:
+            logging.error(f"⚠️ Error deduplicando job en Redis: {e}. Usando fallback local.")
+    existing = exam_job_dedup.get(fingerprint)
+    if existing and _job_pending(await load_exam_job(existing)):
+        return existing
+    exam_job_dedup[fingerprint] = job_id
+    return None
+
+async def release_exam_job(job: dict):
+    """Libera la huella de deduplicación si todavía apunta a este job."""
+    global redis_client
+    fingerprint = job.get("fingerprint")
+    if not fingerprint:
+        return
+    if redis_client:
+        try:
+            key = f"examjob:dedup:{fingerprint}"
+            if await redis_client.get(key) == job["job_id"]:
+                await redis_client.delete(key)
+            return
+        except Exception as e:
+            logging.error(f"⚠️ Error liberando deduplicación en Redis: {e}. Usando fallback local.")
+    if exam_job_dedup.get(fingerprint) == job["job_id"]:
+        del exam_job_dedup[fingerprint]
+
+async def fail_exam_job(job: dict, message: str, error_code: int):
+    job["status"] = job["stage"] = "error"
+    job["error"], job["error_code"] = message, error_code
+    await save_exam_job(job["job_id"], job)
+    await release_exam_job(job)
+
+def _public_job(job: dict) -> dict:
+    return {k: v for k, v in job.items() if k != "fingerprint"}
+
+async def cleanup_exam_jobs():
+    global redis_client
+    if redis_client:
+        return
+    now = time.time()
+    stale = [j for j, d in exam_jobs.items() if now - d.get("created_at", 0) > EXAM_JOB_TTL]
+    for j in stale: del exam_jobs[j]
+    for f in [f for f, j in exam_job_dedup.items() if j not in exam_jobs]: del exam_job_dedup[f]
+    if stale: logging.info(f"🧹 {len(stale)} jobs de examen expirados, {len(exam_jobs)} activos")
+
+# =============================================================================
+# EXAM POOL (REDIS OR LOCAL)
+# =============================================================================
+
+# Preguntas ya reescritas (JSON) por "topic_id:dificultad"
+exam_pool: Dict[str, list] = defaultdict(list)
+# Popularidad por día: solo cuentan hoy y ayer, así un tema que dejó de pedirse sale del warmer
+exam_popularity: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+exam_topic_names: Dict[str, str] = {}
+exam_pool_tokens: Dict[str, int] = defaultdict(int)
+
+def _pool_key(topic_id, difficulty: str) -> str:
+    return f"{topic_id}:{difficulty}"
+
+async def sample_exam_pool(topic_id, difficulty: str, count: int) -> list:
+    global redis_client
+    key = _pool_key(topic_id, difficulty)
+    if redis_client:
+        try:
+            return [json.loads(q) for q in await redis_client.srandmember(f"exampool:{key}", count)]
+        except Exception as e:
+            logging.error(f"⚠️ Error leyendo pool de Redis: {e}. Usando fallback local.")
+    pool = exam_pool.get(key, [])
+    return [json.loads(q) for q in random.sample(pool, min(count, len(pool)))]
+
+async def exam_pool_size(topic_id, difficulty: str) -> int:
+    global redis_client
+    key = _pool_key(topic_id, difficulty)
+    if redis_client:
+        try:
+            return await redis_client.scard(f"exampool:{key}")
+        except Exception as e:
+            logging.error(f"⚠️ Error leyendo pool de Redis: {e}. Usando fallback local.")
+    return len(exam_pool.get(key, []))
+
+async def add_to_exam_pool(topic_id, difficulty: str, questions: list):
+    global redis_client
+    key = _pool_key(topic_id, difficulty)
+    items = [json.dumps(q, ensure_ascii=False) for q in questions]
+    if not items:
+        return
+    if redis_client:
+        try:
+            p = redis_client.pipeline()
+            p.sadd(f"exampool:{key}", *items)
+            p.expire(f"exampool:{key}", EXAM_POOL_TTL)
+            await p.execute()
+            return
+        except Exception as e:
+            logging.error(f"⚠️ Error guardando pool en Redis: {e}. Usando fallback local.")
+    exam_pool[key] = list(dict.fromkeys(exam_pool[key] + items))[-EXAM_POOL_TARGET:]
+
+def _popularity_days() -> list:
+    now = time.time()
+    return [time.strftime('%Y-%m-%d', time.localtime(now)), time.strftime('%Y-%m-%d', time.localtime(now - 86400))]
+
+async def record_exam_popularity(topic_ids: list, difficulty: str, names: dict):
+    global redis_client
+    members = [json.dumps([tid, difficulty]) for tid in topic_ids]
+    names = {str(tid): names[tid] for tid in topic_ids if names.get(tid)}
+    today = _popularity_days()[0]
+    if redis_client:
+        try:
+            key = f"exampool:popularity:{today}"
+            p = redis_client.pipeline()
+            for m in members:
+                p.zincrby(key, 1, m)
+            p.zcard(key)
+            p.expire(key, 2 * 86400)
+            if names:
+                p.hset("exampool:names", mapping=names)
+                p.expire("exampool:names", 2 * 86400)
+            size = (await p.execute())[len(members)]
+            # Se recorta a los EXAM_POPULARITY_MAX más pedidos del día solo al doblarse,
+            # para que un tema nuevo tenga margen de acumular pedidos antes del recorte
+            if size > 2 * EXAM_POPULARITY_MAX:
+                await redis_client.zremrangebyrank(key, 0, -(EXAM_POPULARITY_MAX + 1))
+            return
+        except Exception as e:
+            logging.warning(f"⚠️ Error registrando popularidad en Redis: {e}. Usando fallback local.")
+    for day in [d for d in exam_popularity if d not in _popularity_days()]:
+        del exam_popularity[day]
+    counts = exam_popularity[today]
+    for m in members:
+        counts[m] += 1
+    if len(counts) > 2 * EXAM_POPULARITY_MAX:
+        for m in sorted(counts, key=counts.get)[:len(counts) - EXAM_POPULARITY_MAX]:
+            del counts[m]
+    exam_topic_names.update(names)
+    if len(exam_topic_names) > 2 * EXAM_POPULARITY_MAX:
+        keep = {str(json.loads(m)[0]) for c in exam_popularity.values() for m in c}
+        for tid in [t for t in exam_topic_names if t not in keep]:
+            del exam_topic_names[tid]
+
+async def popular_exam_topics(limit: int) -> list:
+    """Devuelve [(topic_id, dificultad, nombre)] ordenados por exámenes pedidos hoy y ayer."""
+    global redis_client
+    totals: Dict[str, float] = defaultdict(float)
+    if redis_client:
+        try:
+            p = redis_client.pipeline()
+            for day in _popularity_days():
+                p.zrevrange(f"exampool:popularity:{day}", 0, EXAM_POPULARITY_MAX - 1, withscores=True)
+            for ranked in await p.execute():
+                for m, score in ranked:
+                    totals[m] += score
+            top = sorted(totals, key=totals.get, reverse=True)[:limit]
+            names = await redis_client.hgetall("exampool:names") if top else {}
+            return [(tid, diff, names.get(str(tid), "")) for tid, diff in map(json.loads, top)]
+        except Exception as e:
+            logging.warning(f"⚠️ Error leyendo popularidad de Redis: {e}. Usando fallback local.")
+    for day in _popularity_days():
+        for m, count in exam_popularity.get(day, {}).items():
+            totals[m] += count
+    top = sorted(totals, key=totals.get, reverse=True)[:limit]
+    return [(tid, diff, exam_topic_names.get(str(tid), "")) for tid, diff in map(json.loads, top)]
+
+async def add_pool_tokens(tokens: int) -> int:
+    """Suma tokens al gasto del warmer de hoy y devuelve el total."""
+    global redis_client
+    key = f"exampool:tokens:{time.strftime('%Y-%m-%d')}"
+    if redis_client:
+        try:
+            p = redis_client.pipeline()
+            p.incrby(key, tokens)
+            p.expire(key, 2 * 86400)
+            return (await p.execute())[0]
+        except Exception as e:
+            logging.warning(f"⚠️ Error registrando tokens del pool en Redis: {e}. Usando fallback local.")
+    exam_pool_tokens[key] += tokens
+    return exam_pool_tokens[key]
+
+def off_peak_clock() -> int:
+    """Hora actual en EXAM_POOL_TZ; el contenedor suele correr en UTC."""
+    try:
+        tz = ZoneInfo(EXAM_POOL_TZ)
+    except (ZoneInfoNotFoundError, ValueError):
+        logging.warning(f"⚠️ EXAM_POOL_TZ inválida: {EXAM_POOL_TZ!r}. Usando UTC.")
+        tz = timezone.utc
+    return datetime.now(tz).hour
+
+def in_off_peak(hour: int) -> bool:
+    if not EXAM_POOL_OFFPEAK:
+        return True
+    start, end = (int(h) for h in EXAM_POOL_OFFPEAK.split("-"))
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+# =============================================================================
+# METRICS (PROMETHEUS, NO-OP SI NO ESTÁ INSTALADO)
+# =============================================================================
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs): return self
+    def observe(self, *args, **kwargs): pass
+    def inc(self, *args, **kwargs): pass
+
+if PROMETHEUS_AVAILABLE:
+    _LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 90)
+    STAGE_LATENCY = Histogram(
+        "raava_stage_duration_seconds", "Duración de cada etapa de una petición",
+        ["stage", "route", "model"], buckets=_LATENCY_BUCKETS,
+    )
+    OPENROUTER_TTFB = Histogram(
+        "raava_openrouter_first_byte_seconds", "Tiempo hasta la primera respuesta de OpenRouter",
+        ["route", "model"], buckets=_LATENCY_BUCKETS,
+    )
+    RATE_LIMITED = Counter("raava_rate_limited_total", "Solicitudes rechazadas por rate limit", ["route", "model", "scope"])
+    UPSTREAM_STATUS = Counter("raava_upstream_responses_total", "Códigos de estado de servicios externos", ["upstream", "route", "model", "status"])
+    CACHE_REQUESTS = Counter("raava_cache_requests_total", "Consultas a cachés internas", ["cache", "route", "model", "result"])
+else:
+    STAGE_LATENCY = OPENROUTER_TTFB = RATE_LIMITED = UPSTREAM_STATUS = CACHE_REQUESTS = _NoopMetric()
+
+def route_model(route: str) -> str:
+    """Modelo que atiende cada ruta, para etiquetar las métricas que no lo conocen directamente."""
+    if route in ("/generate_exam", "/exam_jobs"):
+        return EXAM_MODEL_NAME
+    if route in ("/chat", "/voice", "/init_session"):
+        return MODEL_NAME
+    return {"/listen": "nova-2", "/talk": RAAVA_VOICE}.get(route, "")
+
+@contextmanager
+def observe(stage: str, route: str, model: str = ""):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage=stage, route=route, model=model).observe(time.perf_counter() - start)
+
 # =============================================================================
 # RATE LIMITER (DISTRIBUTED OR LOCAL)
 # =============================================================================
@@ -174,18 +536,25 @@ class SecurityHeadersMiddleware(BaseHTTPMiddleware):
             response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
         return response
 
+def client_ip(conn: HTTPConnection) -> str:
+    ip = conn.headers.get("x-forwarded-for", "").split(",")[0].strip()
+    if not ip:
+        ip = conn.client.host if conn.client else "unknown"
+    return ip
+
 class RateLimitMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         if request.method == "OPTIONS":
             return await call_next(request)
-        ip = request.headers.get("x-forwarded-for", "").split(",")[0].strip()
-        if not ip:
-            ip = request.client.host if request.client else "unknown"
+        ip = client_ip(request)
+        limits = {"/chat": RATE_CHAT, "/init_session": RATE_INIT, "/listen": RATE_LISTEN, "/talk": RATE_TALK, "/generate_exam": RATE_EXAM, "/exam_jobs": RATE_EXAM}
+        path = request.url.path
+        route = path if path in limits else "other"
         if not await rate_limiter.is_allowed(f"g:{ip}", RATE_GENERAL):
+            RATE_LIMITED.labels(route=route, model=route_model(route), scope="general").inc()
             return JSONResponse(status_code=429, content={"error": "Demasiadas solicitudes."})
-        limits = {"/chat": RATE_CHAT, "/init_session": RATE_INIT, "/listen": RATE_LISTEN, "/talk": RATE_TALK, "/generate_exam": RATE_EXAM}
-        path = request.url.path
         if path in limits and not await rate_limiter.is_allowed(f"{path}:{ip}", limits[path]):
+            RATE_LIMITED.labels(route=route, model=route_model(route), scope="route").inc()
             return JSONResponse(status_code=429, content={"error": "Demasiadas solicitudes para este servicio."})
         return await call_next(request)
 
@@ -248,6 +617,10 @@ class GenerateExamRequest(BaseModel):
     difficulty: str = "Medio"
     count: int = 10
 
+    @validator("topic_ids")
+    def v_topic_ids(cls, v):
+        if not v or len(v) > 10: raise ValueError("topic_ids inválido")
+        return [str(t)[:100] for t in v]
     @validator("topic_names")
     def v_topics(cls, v):
         if not v or len(v) > 10: raise ValueError("topics inválido")
@@ -257,6 +630,12 @@ class GenerateExamRequest(BaseModel):
     @validator("count")
     def v_count(cls, v): return max(5, min(30, v))
 
+class ExamJobRequest(GenerateExamRequest):
+    user_id: Optional[str] = None
+
+    @validator("user_id")
+    def v_uid(cls, v): return v[:100] if v else None
+
 # =============================================================================
 # HELPERS
 # =============================================================================
@@ -267,6 +646,13 @@ _INJECTION_RE = re.compile(
     re.IGNORECASE
 )
 
+class ApiError(Exception):
+    """Error de un pipeline de IA con el código HTTP que debe devolverse al cliente."""
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
 def sanitize(s: str, mx: int = 500) -> str:
     if not s: return ""
     cleaned = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', s[:mx]).strip()
@@ -396,8 +782,9 @@ async def lifespan(_app: FastAPI):
     if not OPENROUTER_API_KEY: logging.warning("⚠️ OPENROUTER_API_KEY no configurada.")
     if not DEEPGRAM_API_KEY:   logging.warning("⚠️ DEEPGRAM_API_KEY no configurada.")
 
-    if REDIS_AVAILABLE and REDIS_URL:
+    if REDIS_URL:
         try:
+            import redis.asyncio as aioredis
             redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
             await redis_client.ping()  # type: ignore[awaitable-return-type]
             logging.info("✅ Redis conectado. Modo Stateless activado.")
@@ -411,10 +798,38 @@ async def lifespan(_app: FastAPI):
         while True:
             await asyncio.sleep(600)
             await cleanup_sessions()
+            await cleanup_exam_jobs()
+
+    global exam_queue
+    exam_queue = asyncio.Queue(maxsize=EXAM_QUEUE_MAX)
+    workers = [asyncio.create_task(exam_worker()) for _ in range(EXAM_WORKERS)]
+
+    async def pool_warmer():
+        while True:
+            await asyncio.sleep(EXAM_POOL_INTERVAL)
+            try:
+                await warm_exam_pool()
+            except Exception as e:
+                logging.error(f"Exam pool warmer error: {e}")
+
+    async def warm_clients():
+        # Fuera del arranque: el primer request ya encuentra los SDKs cargados
+        try:
+            timings = await asyncio.to_thread(preload_sdks)
+            logging.info(f"⏱️ SDKs precargados en {sum(ms for ms, _ in timings):.0f} ms")
+        except Exception as e:
+            logging.error(f"❌ Error precargando SDKs: {e}")
 
     task = asyncio.create_task(periodic())
+    workers.append(asyncio.create_task(warm_clients()))
+    if EXAM_POOL_TOKEN_BUDGET > 0 and redis_client:
+        workers.append(asyncio.create_task(pool_warmer()))
+    elif EXAM_POOL_TOKEN_BUDGET > 0:
+        logging.warning("⚠️ Warmer del pool de exámenes desactivado: requiere Redis.")
+    logging.info(f"⏱️ Arranque listo en {(time.perf_counter() - _BOOT_START) * 1000:.0f} ms")
     yield
     task.cancel()
+    for w in workers: w.cancel()
 
 # =============================================================================
 # APP
@@ -468,6 +883,19 @@ async def health():
         "redis_connected": redis_client is not None,
     }
 
+@app.get("/metrics")
+async def metrics(request: Request):
+    if not PROMETHEUS_AVAILABLE:
+        return JSONResponse(status_code=503, content={"error": "prometheus_client no instalado."})
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        return JSONResponse(status_code=401, content={"error": "No autorizado."})
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Con varios workers de gunicorn se agregan las métricas de todos los procesos
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/token_stats")
 async def token_stats():
     today = time.strftime("%Y-%m-%d")
@@ -483,15 +911,16 @@ async def init_session(req: InitSessionRequest):
     logging.info(f"🆕 Sesión: {req.user_data.get('nombre','?')} → {title}")
 
     history = []
-    if supabase:
+    if SUPABASE_ENABLED:
         try:
-            res = await asyncio.to_thread(
-                lambda: supabase.table("chat_history")
-                        .select("role, content")
-                        .eq("session_id", req.session_id)
-                        .order("created_at")
-                        .execute()
-            )
+            with observe("history_fetch", "/init_session"):
+                res = await asyncio.to_thread(
+                    lambda: get_supabase().table("chat_history")
+                            .select("role, content")
+                            .eq("session_id", req.session_id)
+                            .order("created_at")
+                            .execute()
+                )
             if res.data:
                 history = [{"role": r["role"], "content": r["content"]} for r in res.data]
                 logging.info(f"✅ Historial restaurado: {len(history)} mensajes")
@@ -509,80 +938,130 @@ async def init_session(req: InitSessionRequest):
     await save_session(req.session_id, sess_data)
     return {"status": "success", "topic": title, "history_recovered": len(history), "history": history}
 
-@app.post("/chat")
-async def chat(req: ChatRequest):
-    try:
-        if not OPENROUTER_API_KEY:
-            return JSONResponse(status_code=503, content={"error": "API no configurada."})
+SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+
+async def read_reply_stream(resp: aiohttp.ClientResponse, on_sentence) -> tuple:
+    """Lee el SSE de OpenRouter y entrega cada oración completa a on_sentence en cuanto se cierra."""
+    parts: list = []
+    pending = ""
+    total_tokens = 0
+    async for raw in resp.content:
+        line = raw.decode("utf-8", "ignore").strip()
+        if not line.startswith("data:"):
+            continue
+        payload = line[5:].strip()
+        if payload == "[DONE]":
+            break
+        try:
+            chunk = json.loads(payload)
+        except json.JSONDecodeError:
+            continue
+        total_tokens = (chunk.get("usage") or {}).get("total_tokens", total_tokens)
+        if not chunk.get("choices"):
+            continue
+        delta = chunk["choices"][0].get("delta", {}).get("content") or ""
+        parts.append(delta)
+        *sentences, pending = SENTENCE_END.split(pending + delta)
+        for sentence in sentences:
+            await on_sentence(sentence)
+    if pending.strip():
+        await on_sentence(pending)
+    return "".join(parts), total_tokens
+
+async def generate_reply(client: aiohttp.ClientSession, req: ChatRequest, route: str = "/chat", on_sentence=None) -> str:
+    """
+    Pipeline de chat compartido por /chat y /voice: sesión → prompt → OpenRouter → historial.
 
-        is_mini = req.session_id.startswith("mc_")
+    Con on_sentence la respuesta se pide en streaming y cada oración se entrega
+    en cuanto termina, para que /voice sintetice mientras el modelo sigue escribiendo.
+    """
+    is_mini = req.session_id.startswith("mc_")
+    with observe("session_load", route, MODEL_NAME):
         sess = await get_session(req.session_id)
-        if not sess:
-            history = []
-            if supabase and not is_mini:
-                try:
+    CACHE_REQUESTS.labels(cache="session", route=route, model=MODEL_NAME, result="hit" if sess else "miss").inc()
+    if not sess:
+        history = []
+        if SUPABASE_ENABLED and not is_mini:
+            try:
+                with observe("history_fetch", route, MODEL_NAME):
                     res = await asyncio.to_thread(
-                        lambda: supabase.table("chat_history")
+                        lambda: get_supabase().table("chat_history")
                                 .select("role, content")
                                 .eq("session_id", req.session_id)
                                 .order("created_at")
                                 .execute()
                     )
-                    if res.data:
-                        history = [{"role": r["role"], "content": r["content"]} for r in res.data]
-                except Exception:
-                    pass
-
-            sess = {
-                "history": history,
-                "user_data": req.user_context or {},
-                "topic_data": {"title": req.topic_title or "General"},
-                "current_topic": req.topic_title or "General",
-                "materia_title": "",
-                "last_active": time.time(),
-            }
-
-        sess["last_active"] = time.time()
-        if req.user_context:
-            sess["user_data"].update({k: v for k, v in req.user_context.items() if v})
-        if len(sess["history"]) > MAX_HISTORY:
-            sess["history"] = sess["history"][-MAX_HISTORY:]
+                if res.data:
+                    history = [{"role": r["role"], "content": r["content"]} for r in res.data]
+            except Exception:
+                pass
+
+        sess = {
+            "history": history,
+            "user_data": req.user_context or {},
+            "topic_data": {"title": req.topic_title or "General"},
+            "current_topic": req.topic_title or "General",
+            "materia_title": "",
+            "last_active": time.time(),
+        }
+
+    sess["last_active"] = time.time()
+    if req.user_context:
+        sess["user_data"].update({k: v for k, v in req.user_context.items() if v})
+    if len(sess["history"]) > MAX_HISTORY:
+        sess["history"] = sess["history"][-MAX_HISTORY:]
 
+    with observe("prompt_build", route, MODEL_NAME):
         msgs = [{"role": "system", "content": build_mini_prompt(sess) if is_mini else build_prompt(sess)}]
         msgs.extend(sess["history"][-(6 if is_mini else 10):])
         msgs.append({"role": "user", "content": req.message})
 
-        async with aiohttp.ClientSession() as client:
-            async with client.post(
-                OPENROUTER_URL,
-                json={"model": MODEL_NAME, "messages": msgs, "temperature": 0.4, "max_tokens": 200},
-                headers={"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json", "HTTP-Referer": "https://raavaedu.com"},
-                timeout=aiohttp.ClientTimeout(total=30),
-            ) as resp:
-                if resp.status == 429:
-                    return JSONResponse(status_code=429, content={"error": "La IA está ocupada."})
-                if resp.status != 200:
-                    logging.error(f"OpenRouter {resp.status}: {(await resp.text())[:200]}")
-                    return JSONResponse(status_code=502, content={"error": "La IA no respondió."})
-                data = await resp.json()
-                if not data.get("choices"):
-                    return JSONResponse(status_code=502, content={"error": "Respuesta vacía."})
-                reply = data["choices"][0]["message"]["content"].replace("[[NEXT_TOPIC]]", "").strip()
-                total_tokens = data.get("usage", {}).get("total_tokens", 0)
-                user_id_key = sess["user_data"].get("user_id", "anon")
-                day_key = f"{time.strftime('%Y-%m-%d')}:{user_id_key}"
-                token_counters[day_key] += total_tokens
-                logging.info(f"🪙 {user_id_key} hoy: {token_counters[day_key]:,} tokens (+{total_tokens})")
-
-        sess["history"].append({"role": "user", "content": req.message})
-        sess["history"].append({"role": "assistant", "content": reply})
-        await save_session(req.session_id, sess)
-
-        if supabase and not is_mini:
-            user_id = sess["user_data"].get("user_id")
-            try:
+    payload = {"model": MODEL_NAME, "messages": msgs, "temperature": 0.4, "max_tokens": 200}
+    if on_sentence is not None:
+        payload["stream"] = True
+        payload["usage"] = {"include": True}
+    start = time.perf_counter()
+    async with client.post(
+        OPENROUTER_URL,
+        json=payload,
+        headers={"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json", "HTTP-Referer": "https://raavaedu.com"},
+        timeout=aiohttp.ClientTimeout(total=30),
+    ) as resp:
+        OPENROUTER_TTFB.labels(route=route, model=MODEL_NAME).observe(time.perf_counter() - start)
+        UPSTREAM_STATUS.labels(upstream="openrouter", route=route, model=MODEL_NAME, status=str(resp.status)).inc()
+        if resp.status == 429:
+            raise ApiError(429, "La IA está ocupada.")
+        if resp.status != 200:
+            logging.error(f"OpenRouter {resp.status}: {(await resp.text())[:200]}")
+            raise ApiError(502, "La IA no respondió.")
+        if on_sentence is not None:
+            reply, total_tokens = await read_reply_stream(resp, on_sentence)
+            STAGE_LATENCY.labels(stage="openrouter", route=route, model=MODEL_NAME).observe(time.perf_counter() - start)
+            if not reply.strip():
+                raise ApiError(502, "Respuesta vacía.")
+        else:
+            data = await resp.json()
+            STAGE_LATENCY.labels(stage="openrouter", route=route, model=MODEL_NAME).observe(time.perf_counter() - start)
+            if not data.get("choices"):
+                raise ApiError(502, "Respuesta vacía.")
+            reply = data["choices"][0]["message"]["content"]
+            total_tokens = data.get("usage", {}).get("total_tokens", 0)
+        reply = reply.replace("[[NEXT_TOPIC]]", "").strip()
+        user_id_key = sess["user_data"].get("user_id", "anon")
+        day_key = f"{time.strftime('%Y-%m-%d')}:{user_id_key}"
+        token_counters[day_key] += total_tokens
+        logging.info(f"🪙 {user_id_key} hoy: {token_counters[day_key]:,} tokens (+{total_tokens})")
+
+    sess["history"].append({"role": "user", "content": req.message})
+    sess["history"].append({"role": "assistant", "content": reply})
+    await save_session(req.session_id, sess)
+
+    if SUPABASE_ENABLED and not is_mini:
+        user_id = sess["user_data"].get("user_id")
+        try:
+            with observe("supabase_insert", route, MODEL_NAME):
                 await asyncio.to_thread(
-                    lambda: supabase.table("chat_history").insert({
+                    lambda: get_supabase().table("chat_history").insert({
                         "session_id": req.session_id,
                         "user_id": user_id,
                         "role": "user",
@@ -590,18 +1069,29 @@ async def chat(req: ChatRequest):
                     }).execute()
                 )
                 await asyncio.to_thread(
-                    lambda: supabase.table("chat_history").insert({
+                    lambda: get_supabase().table("chat_history").insert({
                         "session_id": req.session_id,
                         "user_id": user_id,
                         "role": "assistant",
                         "content": reply,
                     }).execute()
                 )
-            except Exception as e:
-                logging.error(f"Error guardando en Supabase: {e}")
+        except Exception as e:
+            logging.error(f"Error guardando en Supabase: {e}")
 
+    return reply
+
+@app.post("/chat")
+async def chat(req: ChatRequest):
+    try:
+        if not OPENROUTER_API_KEY:
+            return JSONResponse(status_code=503, content={"error": "API no configurada."})
+        async with aiohttp.ClientSession() as client:
+            reply = await generate_reply(client, req)
         return {"reply": reply}
 
+    except ApiError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.message})
     except asyncio.TimeoutError:
         return JSONResponse(status_code=504, content={"error": "Timeout."})
     except Exception as e:
@@ -618,16 +1108,18 @@ async def listen(audio: UploadFile = File(...)):
             return JSONResponse(status_code=413, content={"error": "Audio muy grande."})
         if len(content) < 100:
             return {"text": ""}
-        async with aiohttp.ClientSession() as client:
-            async with client.post(
-                "https://api.deepgram.com/v1/listen?model=nova-2&smart_format=true&language=es",
-                headers={"Authorization": f"Token {DEEPGRAM_API_KEY}", "Content-Type": audio.content_type or "audio/wav"},
-                data=content, timeout=aiohttp.ClientTimeout(total=15),
-            ) as resp:
-                if resp.status != 200: return {"text": ""}
-                data = await resp.json()
-                transcript = data.get('results', {}).get('channels', [{}])[0].get('alternatives', [{}])[0].get('transcript', "")
-                logging.info(f"🎤 {transcript[:100]}")
+        with observe("stt", "/listen", "nova-2"):
+            async with aiohttp.ClientSession() as client:
+                async with client.post(
+                    DEEPGRAM_URL,
+                    headers={"Authorization": f"Token {DEEPGRAM_API_KEY}", "Content-Type": audio.content_type or "audio/wav"},
+                    data=content, timeout=aiohttp.ClientTimeout(total=15),
+                ) as resp:
+                    UPSTREAM_STATUS.labels(upstream="deepgram", route="/listen", model="nova-2", status=str(resp.status)).inc()
+                    if resp.status != 200: return {"text": ""}
+                    data = await resp.json()
+                    transcript = data.get('results', {}).get('channels', [{}])[0].get('alternatives', [{}])[0].get('transcript', "")
+        logging.info(f"🎤 {transcript[:100]}")
         return {"text": transcript}
     except asyncio.TimeoutError:
         return {"text": ""}
@@ -642,83 +1134,284 @@ async def talk(req: TalkRequest, background_tasks: BackgroundTasks):
         if not text:
             return JSONResponse(status_code=400, content={"error": "Texto vacío"})
         path = os.path.join(tempfile.gettempdir(), f"tts_{uuid.uuid4().hex}.mp3")
-        await edge_tts.Communicate(text, RAAVA_VOICE).save(path)
+        with observe("tts", "/talk", RAAVA_VOICE):
+            await edge_tts.Communicate(text, RAAVA_VOICE).save(path)
         background_tasks.add_task(rm_temp, path)
         return FileResponse(path, media_type="audio/mpeg", filename="voice.mp3")
     except Exception as e:
         logging.error(f"Talk error: {e}")
         return JSONResponse(status_code=500, content={"error": "Error generando audio."})
 
-@app.post("/generate_exam")
-async def generate_exam(req: GenerateExamRequest):
-    content = ""
-    try:
-        if not OPENROUTER_API_KEY:
-            return JSONResponse(status_code=503, content={"error": "API no configurada."})
+async def stream_tts(ws: WebSocket, text: str):
+    with observe("tts", "/voice", RAAVA_VOICE):
+        async for chunk in edge_tts.Communicate(text, RAAVA_VOICE).stream():
+            if chunk["type"] == "audio":
+                await ws.send_bytes(chunk["data"])
 
-        topics_str = ", ".join(req.topic_names)
-        diff_map = {
-            "Fácil":   "básico, con opciones claras y distractores simples",
-            "Medio":   "intermedio, con conceptos clave y distractores plausibles",
-            "Difícil": "avanzado, con razonamiento profundo y distractores muy similares",
-        }
-        diff_desc = diff_map.get(req.difficulty, "intermedio")
+@app.websocket("/voice")
+async def voice(ws: WebSocket, session_id: str):
+    """
+    Turno de voz completo (STT en vivo → chat → TTS) sobre una sola conexión.
+
+    Cliente → servidor:
+      texto    {"type": "config", "user_context": {...}, "topic_title": "..."}  (opcional)
+      binario  fragmentos de audio del micrófono mientras el alumno habla
+      texto    {"type": "end"}  el alumno terminó de hablar
+    Servidor → cliente:
+      {"type": "transcript", "text": "...", "is_final": bool}
+      binario  audio mp3 con la voz de Raava, oración por oración
+      {"type": "reply", "text": "..."}  la respuesta completa, en cuanto el modelo termina
+      {"type": "error", "error": "..."}
+      {"type": "turn_end"}
+    """
+    # Los middlewares HTTP (CORS, rate limit) no aplican a WebSockets: se validan aquí.
+    if len(session_id) > 100 or not re.match(r'^[a-zA-Z0-9_\-]+$', session_id):
+        await ws.close(code=1008)
+        return
+    origin = ws.headers.get("origin")
+    if origin and origin not in ALLOWED_ORIGINS:
+        await ws.close(code=1008)
+        return
+    ip = client_ip(ws)
+    if not await rate_limiter.is_allowed(f"g:{ip}", RATE_GENERAL):
+        RATE_LIMITED.labels(route="/voice", model=MODEL_NAME, scope="general").inc()
+        await ws.close(code=1008)
+        return
+    if not OPENROUTER_API_KEY or not DEEPGRAM_API_KEY:
+        await ws.close(code=1011)
+        return
 
-        # Distribuir equitativamente las preguntas entre los temas
-        topic_counts = {}
-        for i, tid in enumerate(req.topic_ids):
-            topic_counts[tid] = req.count // len(req.topic_ids) + (1 if i < req.count % len(req.topic_ids) else 0)
+    await ws.accept()
+    user_context: dict = {}
+    topic_title: Optional[str] = None
+    dg: Optional[aiohttp.ClientWebSocketResponse] = None
+    dg_reader: Optional[asyncio.Task] = None
+    finals: list = []
+    received = 0
+    turn_rejected = False
 
-        base_questions = []
-        if supabase:
-            for tid, c in topic_counts.items():
-                if c > 0:
+    async def read_deepgram(conn: aiohttp.ClientWebSocketResponse):
+        try:
+            async for msg in conn:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                data = json.loads(msg.data)
+                if data.get("type") != "Results":
+                    continue
+                text = data.get("channel", {}).get("alternatives", [{}])[0].get("transcript", "")
+                if not text:
+                    continue
+                if data.get("is_final"):
+                    finals.append(text)
+                await ws.send_json({"type": "transcript", "text": text, "is_final": bool(data.get("is_final"))})
+        except Exception as e:
+            logging.error(f"Deepgram live error: {e}")
+
+    try:
+        # Una sola sesión HTTP para todos los turnos: Deepgram, OpenRouter y sus conexiones se reutilizan.
+        async with aiohttp.ClientSession() as client:
+            while True:
+                msg = await ws.receive()
+                if msg["type"] == "websocket.disconnect":
+                    break
+
+                if msg.get("bytes") is not None:
+                    if turn_rejected:
+                        continue
+                    chunk = msg["bytes"]
+                    if dg is None:
+                        # El límite se cobra al iniciar el turno, antes de abrir la conexión con Deepgram
+                        scope = None
+                        if not await rate_limiter.is_allowed(f"g:{ip}", RATE_GENERAL):
+                            scope = "general"
+                        elif not await rate_limiter.is_allowed(f"/voice:{ip}", RATE_VOICE):
+                            scope = "route"
+                        if scope:
+                            RATE_LIMITED.labels(route="/voice", model=MODEL_NAME, scope=scope).inc()
+                            await ws.send_json({"type": "error", "error": "Demasiadas solicitudes para este servicio."})
+                            turn_rejected = True
+                            continue
+                    received += len(chunk)
+                    if received > MAX_AUDIO_SIZE:
+                        await ws.send_json({"type": "error", "error": "Audio muy grande."})
+                        break
+                    if dg is None:
+                        try:
+                            dg = await client.ws_connect(
+                                DEEPGRAM_LIVE_URL,
+                                headers={"Authorization": f"Token {DEEPGRAM_API_KEY}"},
+                            )
+                        except aiohttp.ClientError as e:
+                            status = str(e.status) if isinstance(e, aiohttp.WSServerHandshakeError) else "error"
+                            UPSTREAM_STATUS.labels(upstream="deepgram", route="/voice", model="nova-2", status=status).inc()
+                            logging.error(f"Deepgram live connect error: {e}")
+                            await ws.send_json({"type": "error", "error": "STT no disponible."})
+                            break
+                        UPSTREAM_STATUS.labels(upstream="deepgram", route="/voice", model="nova-2", status="101").inc()
+                        dg_reader = asyncio.create_task(read_deepgram(dg))
                     try:
-                        res = await asyncio.to_thread(
-                            lambda tid_val=tid: supabase.table("question_bank")
-                                    .select("*")
-                                    .eq("topic_id", tid_val)
-                                    .execute()
-                        )
-                        data = res.data or []
-                        if data:
-                            random.shuffle(data)
-                            base_questions.extend(data[:c])
+                        await dg.send_bytes(chunk)
                     except Exception as e:
-                        logging.error(f"Error fetching from question_bank for topic_id {tid}: {e}")
-
-        if not base_questions:
-            # Fallback en caso de que no haya base de datos de preguntas: le pedimos a la IA que las genere.
-            bq_json = "[]"
-            prompt = (
-                f"Genera exactamente {req.count} preguntas de opción múltiple en español sobre: {topics_str}.\n"
-                f"Nivel de dificultad: {diff_desc}.\n\n"
-                "Usa un tono entretenido y personalizado para un estudiante (ej. si aplica, usa analogías de autos, videojuegos, etc).\n\n"
-                "Responde ÚNICAMENTE con JSON válido con esta estructura exacta (sin markdown, sin texto extra):\n"
-                '{"questions": [{"question": "texto de la pregunta","options": ["respuesta correcta","distractor 1","distractor 2","distractor 3"],"correct_answer": "respuesta correcta"}]}\n\n'
-                f"REGLAS: exactamente {req.count} preguntas, 4 opciones c/u, correct_answer idéntico a un valor de options, sin numeración en opciones. Aleatoriza la posición de la respuesta correcta entre las opciones."
-            )
-        else:
-            # Le pedimos a la IA que reescriba las preguntas base
-            bq_json = json.dumps([{"question_text": q["question_text"], "options": q["options"], "correct_answer": q["correct_answer"]} for q in base_questions], ensure_ascii=False)
-            prompt = (
-                f"Actúa como un profesor creativo. Aquí tienes {len(base_questions)} preguntas base sobre: {topics_str}.\n"
-                f"Tu tarea es reescribir estas preguntas para hacerlas más personalizadas y entretenidas para el alumno, "
-                f"manteniendo la dificultad en nivel '{diff_desc}' y conservando el concepto exacto de la respuesta correcta y los distractores.\n\n"
-                f"Ejemplo: Si la pregunta dice 'Juan tiene 7 + 3 manzanas', puedes cambiarla a 'Juan tiene 7 + 3 autos deportivos'.\n\n"
-                f"PREGUNTAS BASE:\n{bq_json}\n\n"
-                "Responde ÚNICAMENTE con JSON válido con la siguiente estructura (sin markdown, sin texto extra):\n"
-                '{"questions": [{"question": "texto personalizado de la pregunta","options": ["opcion 1","opcion 2","opcion 3","opcion 4"],"correct_answer": "opcion correcta"}]}\n\n'
-                f"REGLAS: exactamente {len(base_questions)} preguntas, 4 opciones por pregunta. No incluyas explicaciones."
-            )
+                        # Se descarta la intervención en curso pero la sesión de voz sigue abierta
+                        logging.error(f"Deepgram live send error: {e}")
+                        dg_reader.cancel()
+                        await dg.close()
+                        dg, dg_reader = None, None
+                        finals.clear()
+                        received = 0
+                        await ws.send_json({"type": "error", "error": "Error interno."})
+                        await ws.send_json({"type": "turn_end"})
+                    continue
+
+                try:
+                    data = json.loads(msg.get("text") or "")
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(data, dict):
+                    continue
+
+                if data.get("type") == "config":
+                    if isinstance(data.get("user_context"), dict):
+                        user_context = data["user_context"]
+                    if data.get("topic_title"):
+                        topic_title = str(data["topic_title"])[:200]
+                    continue
+                if data.get("type") != "end":
+                    continue
+                if turn_rejected:
+                    turn_rejected = False
+                    await ws.send_json({"type": "turn_end"})
+                    continue
+
+                try:
+                    transcript = ""
+                    if dg is not None and dg_reader is not None:
+                        # CloseStream hace que Deepgram entregue los últimos resultados y cierre la conexión.
+                        with observe("stt", "/voice", "nova-2"):
+                            await dg.send_str(json.dumps({"type": "CloseStream"}))
+                            try:
+                                await asyncio.wait_for(dg_reader, timeout=10)
+                            except asyncio.TimeoutError:
+                                dg_reader.cancel()
+                        await dg.close()
+                        transcript = " ".join(finals).strip()
+                        dg, dg_reader = None, None
+                        finals.clear()
+                        received = 0
+                    logging.info(f"🎤 {transcript[:100]}")
+
+                    if transcript:
+                        try:
+                            req = ChatRequest(session_id=session_id, message=transcript, user_context=user_context, topic_title=topic_title)
+                            # El TTS de cada oración arranca mientras OpenRouter sigue generando la siguiente
+                            sentences: asyncio.Queue = asyncio.Queue()
+
+                            async def speak():
+                                while (sentence := await sentences.get()) is not None:
+                                    text = clean_tts(sentence)
+                                    if text:
+                                        await stream_tts(ws, text)
+
+                            speaker = asyncio.create_task(speak())
+                            try:
+                                reply = await generate_reply(client, req, route="/voice", on_sentence=sentences.put)
+                            except BaseException:
+                                speaker.cancel()
+                                raise
+                            await sentences.put(None)
+                            await ws.send_json({"type": "reply", "text": reply})
+                            await speaker
+                        except ValidationError:
+                            await ws.send_json({"type": "error", "error": "Mensaje inválido."})
+                        except ApiError as e:
+                            await ws.send_json({"type": "error", "error": e.message})
+                        except asyncio.TimeoutError:
+                            await ws.send_json({"type": "error", "error": "Timeout."})
+                except WebSocketDisconnect:
+                    raise
+                except Exception as e:
+                    # Un fallo de Deepgram, OpenRouter o edge-tts termina el turno, no la sesión de voz
+                    logging.error(f"Voice turn error: {e}")
+                    if dg_reader is not None:
+                        dg_reader.cancel()
+                    if dg is not None:
+                        await dg.close()
+                    dg, dg_reader = None, None
+                    finals.clear()
+                    received = 0
+                    await ws.send_json({"type": "error", "error": "Error interno."})
+                await ws.send_json({"type": "turn_end"})
+
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logging.error(f"Voice error: {e}")
+    finally:
+        if dg_reader is not None:
+            dg_reader.cancel()
+        if dg is not None:
+            await dg.close()
+        try:
+            await ws.close()
+        except Exception:
+            pass
 
-        max_tokens = max(4000, req.count * 300)
+EXAM_DIFFICULTY_DESC = {
+    "Fácil":   "básico, con opciones claras y distractores simples",
+    "Medio":   "intermedio, con conceptos clave y distractores plausibles",
+    "Difícil": "avanzado, con razonamiento profundo y distractores muy similares",
+}
+
+def build_exam_prompt(topics_str: str, diff_desc: str, count: int, base_questions: list) -> str:
+    if not base_questions:
+        # Fallback en caso de que no haya base de datos de preguntas: le pedimos a la IA que las genere.
+        return (
+            f"Genera exactamente {count} preguntas de opción múltiple en español sobre: {topics_str}.\n"
+            f"Nivel de dificultad: {diff_desc}.\n\n"
+            "Usa un tono entretenido y personalizado para un estudiante (ej. si aplica, usa analogías de autos, videojuegos, etc).\n\n"
+            "Responde ÚNICAMENTE con JSON válido con esta estructura exacta (sin markdown, sin texto extra):\n"
+            '{"questions": [{"question": "texto de la pregunta","options": ["respuesta correcta","distractor 1","distractor 2","distractor 3"],"correct_answer": "respuesta correcta"}]}\n\n'
+            f"REGLAS: exactamente {count} preguntas, 4 opciones c/u, correct_answer idéntico a un valor de options, sin numeración en opciones. Aleatoriza la posición de la respuesta correcta entre las opciones."
+        )
+    # Le pedimos a la IA que reescriba las preguntas base
+    bq_json = json.dumps([{"question_text": q["question_text"], "options": q["options"], "correct_answer": q["correct_answer"]} for q in base_questions], ensure_ascii=False)
+    return (
+        f"Actúa como un profesor creativo. Aquí tienes {len(base_questions)} preguntas base sobre: {topics_str}.\n"
+        f"Tu tarea es reescribir estas preguntas para hacerlas más personalizadas y entretenidas para el alumno, "
+        f"manteniendo la dificultad en nivel '{diff_desc}' y conservando el concepto exacto de la respuesta correcta y los distractores.\n\n"
+        f"Ejemplo: Si la pregunta dice 'Juan tiene 7 + 3 manzanas', puedes cambiarla a 'Juan tiene 7 + 3 autos deportivos'.\n\n"
+        f"PREGUNTAS BASE:\n{bq_json}\n\n"
+        "Responde ÚNICAMENTE con JSON válido con la siguiente estructura (sin markdown, sin texto extra):\n"
+        '{"questions": [{"question": "texto personalizado de la pregunta","options": ["opcion 1","opcion 2","opcion 3","opcion 4"],"correct_answer": "opcion correcta"}]}\n\n'
+        f"REGLAS: exactamente {len(base_questions)} preguntas, 4 opciones por pregunta. No incluyas explicaciones."
+    )
+
+async def fetch_question_bank(topic_id, route: str) -> list:
+    if not SUPABASE_ENABLED:
+        return []
+    try:
+        with observe("question_bank_fetch", route):
+            res = await asyncio.to_thread(
+                lambda: get_supabase().table("question_bank")
+                        .select("*")
+                        .eq("topic_id", topic_id)
+                        .execute()
+            )
+        return res.data or []
+    except Exception as e:
+        logging.error(f"Error fetching from question_bank for topic_id {topic_id}: {e}")
+        return []
 
+async def request_exam_questions(prompt: str, max_tokens: int, route: str) -> tuple:
+    """Llama a OpenRouter con el prompt de examen; devuelve (preguntas, tokens usados)."""
+    content = ""
+    try:
+        start = time.perf_counter()
         async with aiohttp.ClientSession() as client:
             async with client.post(
                 OPENROUTER_URL,
                 json={
-                    "model": "meta-llama/llama-3.1-8b-instruct",
+                    "model": EXAM_MODEL_NAME,
                     "messages": [{"role": "user", "content": prompt}],
                     "temperature": 0.7,
                     "max_tokens": max_tokens,
@@ -731,16 +1424,20 @@ async def generate_exam(req: GenerateExamRequest):
                 },
                 timeout=aiohttp.ClientTimeout(total=90),
             ) as resp:
+                OPENROUTER_TTFB.labels(route=route, model=EXAM_MODEL_NAME).observe(time.perf_counter() - start)
+                UPSTREAM_STATUS.labels(upstream="openrouter", route=route, model=EXAM_MODEL_NAME, status=str(resp.status)).inc()
                 if resp.status == 429:
-                    return JSONResponse(status_code=429, content={"error": "La IA está ocupada."})
+                    raise ApiError(429, "La IA está ocupada.")
                 if resp.status != 200:
                     raw = await resp.text()
                     logging.error(f"OpenRouter exam {resp.status}: {raw[:300]}")
-                    return JSONResponse(status_code=502, content={"error": "Error al generar examen."})
+                    raise ApiError(502, "Error al generar examen.")
                 data = await resp.json()
+                STAGE_LATENCY.labels(stage="openrouter", route=route, model=EXAM_MODEL_NAME).observe(time.perf_counter() - start)
                 if not data.get("choices"):
-                    return JSONResponse(status_code=502, content={"error": "Respuesta vacía."})
+                    raise ApiError(502, "Respuesta vacía.")
                 content = data["choices"][0]["message"]["content"]
+                total_tokens = data.get("usage", {}).get("total_tokens", 0)
 
         content = re.sub(r'^```(?:json)?\s*', '', content.strip(), flags=re.MULTILINE)
         content = re.sub(r'```\s*$', '', content.strip(), flags=re.MULTILINE).strip()
@@ -751,28 +1448,278 @@ async def generate_exam(req: GenerateExamRequest):
         logging.info(f"📝 Exam raw preview: {content[:120]}")
 
         exam_data = json.loads(content)
-        questions = exam_data.get("questions", [])
-        if not questions:
-            return JSONResponse(status_code=502, content={"error": "No se generaron preguntas."})
-            
-        for q in questions:
-            opts = q.get("options", [])
-            correct = q.get("correct_answer")
-            if opts and isinstance(opts, list) and correct in opts:
-                random.shuffle(opts)
-                q["options"] = opts
-
-        return {"questions": questions}
+        return exam_data.get("questions", []), total_tokens
 
     except json.JSONDecodeError as e:
         logging.error(f"JSON parse error exam: {e} | content: {content[:200]}")
-        return JSONResponse(status_code=502, content={"error": "Error parseando respuesta de IA."})
+        raise ApiError(502, "Error parseando respuesta de IA.")
     except asyncio.TimeoutError:
-        return JSONResponse(status_code=504, content={"error": "Timeout generando examen."})
+        raise ApiError(504, "Timeout generando examen.")
+
+async def build_exam(req: GenerateExamRequest, route: str = "/generate_exam", on_stage: Optional[Callable[[str], Awaitable[None]]] = None) -> list:
+    """Genera las preguntas de un examen; compartido por /generate_exam y los jobs de /exam_jobs."""
+    async def stage(name: str):
+        if on_stage:
+            await on_stage(name)
+
+    diff_desc = EXAM_DIFFICULTY_DESC.get(req.difficulty, "intermedio")
+    topic_names = dict(zip(req.topic_ids, req.topic_names))
+
+    # Distribuir equitativamente las preguntas entre los temas
+    topic_counts = {}
+    for i, tid in enumerate(req.topic_ids):
+        topic_counts[tid] = req.count // len(req.topic_ids) + (1 if i < req.count % len(req.topic_ids) else 0)
+    # Solo cuentan para el warmer los temas que de verdad reciben preguntas
+    await record_exam_popularity([tid for tid, c in topic_counts.items() if c > 0], req.difficulty, topic_names)
+
+    # Primero se toman preguntas ya reescritas del pool; el modelo solo cubre lo que falte
+    await stage("fetching_questions")
+    questions = []
+    gap_counts = {}
+    for tid, c in topic_counts.items():
+        if c <= 0:
+            continue
+        pooled = await sample_exam_pool(tid, req.difficulty, c)
+        CACHE_REQUESTS.labels(cache="exam_pool", route=route, model=EXAM_MODEL_NAME, result="hit" if len(pooled) == c else ("partial" if pooled else "miss")).inc()
+        questions.extend(pooled)
+        if len(pooled) < c:
+            gap_counts[tid] = c - len(pooled)
+
+    if gap_counts:
+        base_questions = []
+        for tid, c in gap_counts.items():
+            data = await fetch_question_bank(tid, route)
+            random.shuffle(data)
+            base_questions.extend(data[:c])
+
+        gap = sum(gap_counts.values())
+        topics_str = ", ".join(topic_names.get(tid, "") for tid in gap_counts if topic_names.get(tid)) or ", ".join(req.topic_names)
+        prompt = build_exam_prompt(topics_str, diff_desc, gap, base_questions)
+        await stage("generating")
+        generated, _ = await request_exam_questions(prompt, max(4000, gap * 300), route)
+        questions.extend(generated)
+
+    if not questions:
+        raise ApiError(502, "No se generaron preguntas.")
+
+    for q in questions:
+        opts = q.get("options", [])
+        correct = q.get("correct_answer")
+        if opts and isinstance(opts, list) and correct in opts:
+            random.shuffle(opts)
+            q["options"] = opts
+
+    return questions
+
+def _valid_question(q) -> bool:
+    return (
+        isinstance(q, dict) and isinstance(q.get("question"), str)
+        and isinstance(q.get("options"), list) and len(q["options"]) >= 2
+        and q.get("correct_answer") in q["options"]
+    )
+
+async def warm_exam_pool():
+    """Rellena el pool de los temas más pedidos en horario valle, sin pasar del presupuesto diario de tokens."""
+    global redis_client
+    # Pool, popularidad, presupuesto y lock deben ser compartidos entre workers
+    if not redis_client or not OPENROUTER_API_KEY or not SUPABASE_ENABLED or not in_off_peak(off_peak_clock()):
+        return
+    # Con varios workers solo uno rellena el pool por ciclo
+    if not await redis_client.set("exampool:lock", "1", nx=True, ex=EXAM_POOL_INTERVAL):
+        return
+
+    spent = await add_pool_tokens(0)
+    for tid, difficulty, name in await popular_exam_topics(EXAM_POOL_TOPICS):
+        if spent >= EXAM_POOL_TOKEN_BUDGET:
+            logging.info(f"🔥 Presupuesto del pool agotado: {spent:,} tokens hoy")
+            break
+        need = min(EXAM_POOL_BATCH, EXAM_POOL_TARGET - await exam_pool_size(tid, difficulty))
+        if need <= 0:
+            continue
+        rows = await fetch_question_bank(tid, "warmer")
+        if not rows:
+            continue
+        rows = random.sample(rows, min(need, len(rows)))
+        prompt = build_exam_prompt(name or str(tid), EXAM_DIFFICULTY_DESC.get(difficulty, "intermedio"), len(rows), rows)
+        try:
+            questions, tokens = await request_exam_questions(prompt, max(4000, len(rows) * 300), "warmer")
+        except ApiError as e:
+            logging.warning(f"🔥 Pool {tid}/{difficulty}: {e.message}")
+            if e.status_code == 429:
+                break
+            continue
+        valid = [q for q in questions if _valid_question(q)]
+        await add_to_exam_pool(tid, difficulty, valid)
+        spent = await add_pool_tokens(tokens)
+        logging.info(f"🔥 Pool {tid}/{difficulty}: +{len(valid)} preguntas ({tokens:,} tokens, {spent:,} hoy)")
+
+@app.post("/generate_exam")
+async def generate_exam(req: GenerateExamRequest):
+    try:
+        if not OPENROUTER_API_KEY:
+            return JSONResponse(status_code=503, content={"error": "API no configurada."})
+        return {"questions": await build_exam(req)}
+    except ApiError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.message})
     except Exception as e:
         logging.error(f"Generate exam error: {e}")
         return JSONResponse(status_code=500, content={"error": "Error interno."})
 
+async def run_exam_job(job_id: str, req: GenerateExamRequest):
+    job = await get_exam_job(job_id)
+    if not job or job["status"] != "queued":
+        return  # expiró o ya se dio por abandonado
+    STAGE_LATENCY.labels(stage="job_queue_wait", route="/exam_jobs", model=EXAM_MODEL_NAME).observe(time.time() - job["created_at"])
+
+    async def on_stage(name: str):
+        job["status"] = "running"
+        job["stage"] = name
+        await save_exam_job(job_id, job)
+
+    try:
+        job["questions"] = await build_exam(req, route="/exam_jobs", on_stage=on_stage)
+    except ApiError as e:
+        await fail_exam_job(job, e.message, e.status_code)
+        return
+    except Exception as e:
+        logging.error(f"Exam job {job_id} error: {e}")
+        await fail_exam_job(job, "Error interno.", 500)
+        return
+    # Un examen terminado no se deduplica: una nueva solicitud genera otro examen
+    job["status"] = job["stage"] = "done"
+    await save_exam_job(job_id, job)
+    await release_exam_job(job)
+
+async def exam_worker():
+    while True:
+        job_id, req = await exam_queue.get()
+        try:
+            await run_exam_job(job_id, req)
+        finally:
+            exam_queue.task_done()
+
+_JOB_ID_RE = re.compile(r'^[a-f0-9]{32}$')
+
+@app.post("/exam_jobs")
+async def create_exam_job(req: ExamJobRequest, request: Request):
+    if not OPENROUTER_API_KEY:
+        return JSONResponse(status_code=503, content={"error": "API no configurada."})
+    if exam_queue is None or exam_queue.full():
+        return JSONResponse(status_code=503, content={"error": "Demasiados exámenes en cola."})
+
+    owner = req.user_id or client_ip(request)
+    fingerprint = hashlib.sha1(
+        json.dumps([owner, req.topic_ids, req.difficulty, req.count], default=str).encode()
+    ).hexdigest()
+    job_id = uuid.uuid4().hex
+    existing = await claim_exam_job(fingerprint, job_id)
+    if existing:
+        job = await get_exam_job(existing) or {}
+        return JSONResponse(status_code=202, content={"job_id": existing, "status": job.get("status", "queued"), "deduplicated": True})
+
+    job = {"job_id": job_id, "status": "queued", "stage": "queued", "created_at": time.time(), "questions": None, "error": None, "fingerprint": fingerprint}
+    await save_exam_job(job_id, job)
+    try:
+        exam_queue.put_nowait((job_id, req))
+    except asyncio.QueueFull:
+        # La cola pudo llenarse mientras se guardaba el job
+        await fail_exam_job(job, "Demasiados exámenes en cola.", 503)
+        return JSONResponse(status_code=503, content={"error": "Demasiados exámenes en cola."})
+    logging.info(f"📝 Exam job {job_id} en cola ({exam_queue.qsize()}/{EXAM_QUEUE_MAX})")
+    return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued", "deduplicated": False})
+
+@app.get("/exam_jobs/{job_id}")
+async def exam_job_status(job_id: str):
+    job = await load_exam_job(job_id) if _JOB_ID_RE.match(job_id) else None
+    if not job:
+        return JSONResponse(status_code=404, content={"error": "Job no encontrado."})
+    return _public_job(job)
+
+@app.get("/exam_jobs/{job_id}/events")
+async def exam_job_events(job_id: str):
+    if not _JOB_ID_RE.match(job_id) or not await get_exam_job(job_id):
+        return JSONResponse(status_code=404, content={"error": "Job no encontrado."})
+
+    async def events():
+        last = None
+        deadline = time.monotonic() + 120
+        while time.monotonic() < deadline:
+            job = await load_exam_job(job_id)
+            if not job:
+                yield f"event: error\ndata: {json.dumps({'error': 'Job expirado.'})}\n\n"
+                return
+            if (job["status"], job.get("stage")) != last:
+                last = (job["status"], job.get("stage"))
+                yield f"data: {json.dumps(_public_job(job), ensure_ascii=False)}\n\n"
+            if job["status"] in ("done", "error"):
+                return
+            await asyncio.sleep(1)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# =============================================================================
+# STARTUP PROFILE
+# =============================================================================
+
+def profile_startup(target_ms: float) -> int:
+    """Reporta el tiempo de import (proceso limpio), del lifespan y de la precarga de SDKs, y los compara con el objetivo."""
+    import subprocess
+
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+    )
+    # -X importtime lista los hijos antes que el padre, con dos espacios de sangría por nivel
+    imports, children, import_ms = [], [], 0.0
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        ms = int(parts[1]) / 1000
+        if not name.startswith("  "):
+            if name.strip() == "app":
+                imports, import_ms = children, ms
+            children = []
+        elif not name.startswith("    "):
+            children.append((ms, name.strip()))
+
+    # La misma precarga que hace el lifespan en segundo plano; se mide antes para que no compitan
+    preload = preload_sdks()
+    preload_ms = sum(ms for ms, _ in preload)
+
+    async def run_lifespan() -> float:
+        start = time.perf_counter()
+        async with lifespan(app):
+            return (time.perf_counter() - start) * 1000
+    lifespan_ms = asyncio.run(run_lifespan())
+
+    # La precarga no bloquea el arranque pero sí consume CPU de cada worker, por eso cuenta en el total
+    total = import_ms + lifespan_ms + preload_ms
+    print("\n⏱️  Imports directos de app (proceso limpio), top 10:")
+    for ms, name in sorted(imports, reverse=True)[:10]:
+        print(f"   {ms:8.1f} ms  {name}")
+    print("\n💤 Precarga de SDKs en segundo plano:")
+    for ms, name in preload:
+        print(f"   {ms:8.1f} ms  {name}")
+    print(f"\n   import app   {import_ms:8.1f} ms")
+    print(f"   lifespan     {lifespan_ms:8.1f} ms")
+    print(f"   precarga     {preload_ms:8.1f} ms")
+    print(f"   total        {total:8.1f} ms  (objetivo {target_ms:.0f} ms)")
+    if total > target_ms:
+        print(f"\n❌ Arranque por encima del objetivo ({total:.0f} > {target_ms:.0f} ms)")
+        return 1
+    print("\n✅ Arranque dentro del objetivo")
+    return 0
+
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Raava Edu API")
+    parser.add_argument("--profile-startup", action="store_true", help="reporta tiempos de import y arranque y termina")
+    parser.add_argument("--target-ms", type=float, default=float(os.getenv("STARTUP_TARGET_MS", "1500")))
+    args = parser.parse_args()
+    if args.profile_startup:
+        sys.exit(profile_startup(args.target_ms))
+
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
@@ -0,0 +1,12 @@
+"""
+Benchmarks sin conexión para la API de Raava.
+
+    python -m bench.run --scenario classroom
+    python -m bench.run --scenario exam --concurrency 20
+    python -m bench.run --scenario voice --latency-scale 0.2
+    python -m bench.run --scenario all --openrouter-429 0.05
+
+bench.fakes levanta servidores locales que imitan OpenRouter, Deepgram,
+las tablas REST de Supabase y un TTS; bench.serve_app arranca app.py apuntando
+a ellos, y bench.run genera la carga y reporta p50/p99 y solicitudes por segundo.
+"""
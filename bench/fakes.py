@@ -0,0 +1,221 @@
+"""
+Servicios externos simulados: OpenRouter, Deepgram (REST y live), Supabase REST y TTS.
+
+    python -m bench.fakes --port 9100 --latency-scale 1.0 --openrouter-429 0.02
+
+Las latencias siguen una distribución log-normal alrededor de medianas
+realistas; --latency-scale las multiplica para correr escenarios más rápidos.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+from collections import defaultdict
+
+from aiohttp import WSMsgType, web
+
+# Medianas en segundos
+OPENROUTER_TTFT   = 0.35
+OPENROUTER_TOK_S  = 150.0
+DEEPGRAM_BASE     = 0.25
+DEEPGRAM_FINALIZE = 0.15
+SUPABASE_QUERY    = 0.04
+TTS_BASE          = 0.20
+TTS_PER_CHAR      = 0.004
+
+CHAT_REPLY = (
+    "¡Muy bien! Piensa en las fracciones como las vueltas de una carrera: si completas 3 de 4 vueltas, "
+    "llevas tres cuartos del recorrido. ¿Cuántas vueltas te faltarían si llevas 1/4?"
+)
+TRANSCRIPT = "no entiendo cómo sumar fracciones con distinto denominador"
+
+def _lognormal(median: float, sigma: float = 0.35) -> float:
+    return median * math.exp(random.gauss(0, sigma))
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+class Fakes:
+    def __init__(self, latency_scale: float, openrouter_429: float):
+        self.scale = latency_scale
+        self.openrouter_429 = openrouter_429
+        self.chat_history: dict = defaultdict(list)
+        self.question_bank: dict = {}
+
+    async def sleep(self, median: float):
+        await asyncio.sleep(_lognormal(median) * self.scale)
+
+    # -------------------------------------------------------------------------
+    # OpenRouter
+    # -------------------------------------------------------------------------
+
+    def _exam_content(self, prompt: str) -> str:
+        m = re.search(r'(?:exactamente|tienes) (\d+) preguntas', prompt)
+        count = int(m.group(1)) if m else 10
+        questions = []
+        for i in range(count):
+            opts = [f"Respuesta correcta {i}", f"Distractor {i}a", f"Distractor {i}b", f"Distractor {i}c"]
+            questions.append({"question": f"Si un auto recorre {i + 2}/4 de la pista, ¿qué fracción le falta?", "options": opts, "correct_answer": opts[0]})
+        return json.dumps({"questions": questions}, ensure_ascii=False)
+
+    async def openrouter(self, request: web.Request):
+        body = await request.json()
+        if random.random() < self.openrouter_429:
+            await self.sleep(0.05)
+            return web.json_response({"error": {"code": 429, "message": "Rate limit exceeded"}}, status=429)
+
+        prompt = body["messages"][-1]["content"]
+        is_json = (body.get("response_format") or {}).get("type") == "json_object"
+        content = self._exam_content(prompt) if is_json else CHAT_REPLY
+        prompt_tokens = sum(_tokens(m["content"]) for m in body["messages"])
+        completion_tokens = _tokens(content)
+        gen_time = completion_tokens / OPENROUTER_TOK_S
+
+        await self.sleep(OPENROUTER_TTFT)
+        if body.get("stream"):
+            resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await resp.prepare(request)
+            pieces = re.findall(r'.{1,16}', content, flags=re.DOTALL)
+            for piece in pieces:
+                chunk = {"id": "gen-bench", "model": body.get("model"), "choices": [{"index": 0, "delta": {"content": piece}}]}
+                await resp.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                await asyncio.sleep(gen_time * self.scale / len(pieces))
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+            await resp.write(f"data: {json.dumps({'id': 'gen-bench', 'choices': [], 'usage': usage})}\n\n".encode())
+            await resp.write(b"data: [DONE]\n\n")
+            await resp.write_eof()
+            return resp
+
+        await asyncio.sleep(gen_time * self.scale)
+        return web.json_response({
+            "id": f"gen-{uuid.uuid4().hex[:12]}",
+            "model": body.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    # -------------------------------------------------------------------------
+    # Deepgram
+    # -------------------------------------------------------------------------
+
+    @staticmethod
+    def _results(transcript: str, is_final: bool) -> dict:
+        return {
+            "type": "Results",
+            "is_final": is_final,
+            "speech_final": is_final,
+            "channel": {"alternatives": [{"transcript": transcript, "confidence": 0.97}]},
+        }
+
+    async def deepgram_listen(self, request: web.Request):
+        if request.headers.get("Upgrade", "").lower() == "websocket":
+            return await self.deepgram_live(request)
+        audio = await request.read()
+        await self.sleep(DEEPGRAM_BASE + len(audio) / 2_000_000)
+        return web.json_response({
+            "metadata": {"request_id": uuid.uuid4().hex, "duration": len(audio) / 16000},
+            "results": {"channels": [{"alternatives": [{"transcript": TRANSCRIPT, "confidence": 0.97}]}]},
+        })
+
+    async def deepgram_live(self, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        words = TRANSCRIPT.split()
+        received = 0
+        async for msg in ws:
+            if msg.type == WSMsgType.BINARY:
+                received += 1
+                if received % 5 == 0:
+                    partial = " ".join(words[:min(len(words), received // 5 * 2)])
+                    await ws.send_json(self._results(partial, False))
+            elif msg.type == WSMsgType.TEXT and json.loads(msg.data).get("type") == "CloseStream":
+                await self.sleep(DEEPGRAM_FINALIZE)
+                await ws.send_json(self._results(TRANSCRIPT, True))
+                await ws.send_json({"type": "Metadata", "request_id": uuid.uuid4().hex})
+                break
+        await ws.close()
+        return ws
+
+    # -------------------------------------------------------------------------
+    # Supabase REST (PostgREST)
+    # -------------------------------------------------------------------------
+
+    @staticmethod
+    def _eq(request: web.Request, column: str) -> str:
+        return request.query.get(column, "").removeprefix("eq.")
+
+    def _questions(self, topic_id: str) -> list:
+        if topic_id not in self.question_bank:
+            rows = []
+            for i in range(40):
+                opts = [f"{i + 1}/4", f"{i + 2}/4", f"{i + 3}/8", f"{i + 1}/2"]
+                rows.append({
+                    "id": f"{topic_id}-{i}",
+                    "topic_id": topic_id,
+                    "difficulty": ["Fácil", "Medio", "Difícil"][i % 3],
+                    "question_text": f"Juan tiene {i + 1} de 4 manzanas, ¿qué fracción tiene?",
+                    "options": opts,
+                    "correct_answer": opts[0],
+                })
+            self.question_bank[topic_id] = rows
+        return self.question_bank[topic_id]
+
+    async def chat_history_select(self, request: web.Request):
+        await self.sleep(SUPABASE_QUERY)
+        rows = self.chat_history.get(self._eq(request, "session_id"), [])
+        return web.json_response([{"role": r["role"], "content": r["content"]} for r in rows])
+
+    async def chat_history_insert(self, request: web.Request):
+        await self.sleep(SUPABASE_QUERY)
+        body = await request.json()
+        rows = body if isinstance(body, list) else [body]
+        out = []
+        for row in rows:
+            row = {"id": len(self.chat_history[row["session_id"]]) + 1, "created_at": time.time(), **row}
+            self.chat_history[row["session_id"]].append(row)
+            out.append(row)
+        return web.json_response(out, status=201)
+
+    async def question_bank_select(self, request: web.Request):
+        await self.sleep(SUPABASE_QUERY)
+        return web.json_response(self._questions(self._eq(request, "topic_id")))
+
+    # -------------------------------------------------------------------------
+    # TTS
+    # -------------------------------------------------------------------------
+
+    async def tts(self, request: web.Request):
+        text = (await request.json()).get("text", "")
+        await self.sleep(TTS_BASE)
+        resp = web.StreamResponse(headers={"Content-Type": "audio/mpeg"})
+        await resp.prepare(request)
+        # ~1 KB de mp3 (24 kbps) por cada ~12 caracteres de texto
+        chunks = max(1, len(text) // 12)
+        for _ in range(chunks):
+            await resp.write(random.randbytes(1024))
+            await asyncio.sleep(TTS_PER_CHAR * 12 * self.scale)
+        await resp.write_eof()
+        return resp
+
+def build_app(latency_scale: float = 1.0, openrouter_429: float = 0.0) -> web.Application:
+    fakes = Fakes(latency_scale, openrouter_429)
+    app = web.Application(client_max_size=32 * 1024 * 1024)
+    app.router.add_post("/api/v1/chat/completions", fakes.openrouter)
+    app.router.add_route("*", "/v1/listen", fakes.deepgram_listen)
+    app.router.add_get("/rest/v1/chat_history", fakes.chat_history_select)
+    app.router.add_post("/rest/v1/chat_history", fakes.chat_history_insert)
+    app.router.add_get("/rest/v1/question_bank", fakes.question_bank_select)
+    app.router.add_post("/tts", fakes.tts)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--openrouter-429", type=float, default=0.0, help="probabilidad de responder 429")
+    args = parser.parse_args()
+    web.run_app(build_app(args.latency_scale, args.openrouter_429), host="127.0.0.1", port=args.port, print=None)
@@ -0,0 +1,261 @@
+"""
+Escenarios de carga contra la API de Raava con servicios externos simulados.
+
+    python -m bench.run --scenario classroom --students 30 --turns 5
+    python -m bench.run --scenario exam --concurrency 20
+    python -m bench.run --scenario voice --students 10 --turns 3
+    python -m bench.run --scenario all --latency-scale 0.2 --openrouter-429 0.05
+    python -m bench.run --scenario classroom --target http://127.0.0.1:9000   # app ya levantada
+
+Escenarios:
+  classroom  ráfaga de un salón: todos los alumnos abren sesión y conversan a la vez en /chat
+  exam       tormenta de exámenes: /generate_exam concurrente
+  exam_jobs  la misma tormenta por /exam_jobs, con sondeo hasta que el job termina
+  voice      turnos de voz por /voice (WebSocket)
+  voice_http los mismos turnos con tres peticiones: /listen → /chat → /talk
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class Recorder:
+    def __init__(self):
+        self.latencies: dict = defaultdict(list)
+        self.errors: dict = defaultdict(int)
+
+    async def timed(self, op: str, coro):
+        start = time.perf_counter()
+        try:
+            ok = await coro
+        except Exception:
+            ok = False
+        if ok:
+            self.record(op, time.perf_counter() - start)
+        else:
+            self.errors[op] += 1
+        return ok
+
+    def record(self, op: str, seconds: float):
+        self.latencies[op].append(seconds)
+
+    def report(self, scenario: str, elapsed: float):
+        print(f"\n== {scenario} ({elapsed:.2f}s) ==")
+        print(f"{'operación':<22}{'ok':>7}{'errores':>9}{'p50 ms':>10}{'p99 ms':>10}{'req/s':>9}")
+        for op in sorted(set(self.latencies) | set(self.errors)):
+            lat = sorted(self.latencies[op])
+            total = len(lat) + self.errors[op]
+            p50 = _percentile(lat, 50) * 1000
+            p99 = _percentile(lat, 99) * 1000
+            print(f"{op:<22}{len(lat):>7}{self.errors[op]:>9}{p50:>10.1f}{p99:>10.1f}{total / elapsed:>9.1f}")
+
+def _percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    # Rango más cercano: el menor valor que cubre al menos pct% de las muestras
+    idx = max(0, min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1))
+    return values[idx]
+
+def _student(i: int) -> dict:
+    return {"nombre": f"Alumno{i}", "user_id": f"bench-{i}", "q1": "los autos de carreras", "q2": ["deportes"]}
+
+# =============================================================================
+# ESCENARIOS
+# =============================================================================
+
+async def _post_ok(client: aiohttp.ClientSession, url: str, **kwargs) -> bool:
+    async with client.post(url, **kwargs) as resp:
+        await resp.read()
+        return resp.status == 200
+
+async def classroom(client: aiohttp.ClientSession, target: str, rec: Recorder, args):
+    async def student(i: int):
+        sid = f"bench_{i}_{random.getrandbits(32):x}"
+        await rec.timed("init_session", _post_ok(client, f"{target}/init_session", json={
+            "session_id": sid, "user_data": _student(i), "current_topic": "Fracciones",
+        }))
+        for _ in range(args.turns):
+            await rec.timed("chat", _post_ok(client, f"{target}/chat", json={
+                "session_id": sid, "message": "¿Cómo sumo 1/2 + 1/4?",
+            }))
+            await asyncio.sleep(random.uniform(0, args.think))
+
+    await asyncio.gather(*(student(i) for i in range(args.students)))
+
+async def exam_storm(client: aiohttp.ClientSession, target: str, rec: Recorder, args):
+    async def student(i: int):
+        topics = random.sample(["t-fracciones", "t-decimales", "t-porcentajes", "t-algebra"], k=2)
+        await rec.timed("generate_exam", _post_ok(client, f"{target}/generate_exam", json={
+            "topic_ids": topics, "topic_names": topics, "difficulty": "Medio", "count": 10,
+        }, timeout=aiohttp.ClientTimeout(total=120)))
+
+    await asyncio.gather(*(student(i) for i in range(args.concurrency)))
+
+EXAM_JOB_TIMEOUT = 120
+
+async def _exam_job(client: aiohttp.ClientSession, target: str, payload: dict) -> bool:
+    async with client.post(f"{target}/exam_jobs", json=payload) as resp:
+        if resp.status != 202:
+            return False
+        job_id = (await resp.json())["job_id"]
+    # Un job que nadie procesa no debe colgar el benchmark: se cuenta como error
+    deadline = time.monotonic() + EXAM_JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+        async with client.get(f"{target}/exam_jobs/{job_id}") as resp:
+            job = await resp.json()
+        if job["status"] in ("done", "error"):
+            return job["status"] == "done"
+    return False
+
+async def exam_jobs_storm(client: aiohttp.ClientSession, target: str, rec: Recorder, args):
+    async def student(i: int):
+        topics = random.sample(["t-fracciones", "t-decimales", "t-porcentajes", "t-algebra"], k=2)
+        await rec.timed("exam_job", _exam_job(client, target, {
+            "topic_ids": topics, "topic_names": topics, "difficulty": "Medio", "count": 10, "user_id": f"bench-{i}",
+        }))
+
+    await asyncio.gather(*(student(i) for i in range(args.concurrency)))
+
+AUDIO_CHUNK = bytes(4096)
+AUDIO_CHUNKS = 25
+
+async def _voice_ws_turn(ws: aiohttp.ClientWebSocketResponse, rec: Recorder) -> bool:
+    for _ in range(AUDIO_CHUNKS):
+        await ws.send_bytes(AUDIO_CHUNK)
+    await ws.send_str(json.dumps({"type": "end"}))
+    # Lo que percibe el alumno: desde que termina de hablar hasta que empieza a oír a Raava
+    end_sent = time.perf_counter()
+    got_audio = False
+    async for msg in ws:
+        if msg.type == aiohttp.WSMsgType.BINARY:
+            if not got_audio:
+                rec.record("voice_ws_first_audio", time.perf_counter() - end_sent)
+            got_audio = True
+        elif msg.type == aiohttp.WSMsgType.TEXT:
+            data = json.loads(msg.data)
+            if data["type"] == "error":
+                return False
+            if data["type"] == "turn_end":
+                return got_audio
+        else:
+            return False
+    return False
+
+async def _voice_http_turn(client: aiohttp.ClientSession, target: str, sid: str) -> bool:
+    form = aiohttp.FormData()
+    form.add_field("audio", AUDIO_CHUNK * AUDIO_CHUNKS, filename="audio.webm", content_type="audio/webm")
+    async with client.post(f"{target}/listen", data=form) as resp:
+        text = (await resp.json()).get("text")
+    if not text:
+        return False
+    async with client.post(f"{target}/chat", json={"session_id": sid, "message": text}) as resp:
+        if resp.status != 200:
+            return False
+        reply = (await resp.json())["reply"]
+    return await _post_ok(client, f"{target}/talk", json={"text": reply})
+
+async def voice_loop(client: aiohttp.ClientSession, target: str, rec: Recorder, args):
+    ws_target = target.replace("http", "ws", 1)
+
+    async def student(i: int):
+        sid = f"bench_v{i}_{random.getrandbits(32):x}"
+        ws = None
+
+        async def open_ws() -> bool:
+            nonlocal ws
+            ws = await client.ws_connect(f"{ws_target}/voice?session_id={sid}")
+            return True
+
+        # Un socket rechazado se registra como error en lugar de abortar todo el escenario
+        if not await rec.timed("voice_ws_connect", open_ws()):
+            return
+        async with ws:
+            await ws.send_str(json.dumps({"type": "config", "user_context": _student(i), "topic_title": "Fracciones"}))
+            for _ in range(args.turns):
+                await rec.timed("voice_ws_turn", _voice_ws_turn(ws, rec))
+                await asyncio.sleep(random.uniform(0, args.think))
+
+    await asyncio.gather(*(student(i) for i in range(args.students)))
+
+async def voice_http_loop(client: aiohttp.ClientSession, target: str, rec: Recorder, args):
+    async def student(i: int):
+        sid = f"bench_h{i}_{random.getrandbits(32):x}"
+        for _ in range(args.turns):
+            await rec.timed("voice_http_turn", _voice_http_turn(client, target, sid))
+            await asyncio.sleep(random.uniform(0, args.think))
+
+    await asyncio.gather(*(student(i) for i in range(args.students)))
+
+SCENARIOS = {"classroom": classroom, "exam": exam_storm, "exam_jobs": exam_jobs_storm, "voice": voice_loop, "voice_http": voice_http_loop}
+
+# =============================================================================
+# ORQUESTACIÓN
+# =============================================================================
+
+async def _wait_ready(url: str, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as client:
+        while time.monotonic() < deadline:
+            try:
+                async with client.get(url) as resp:
+                    if resp.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} no respondió en {timeout}s")
+
+async def main(args):
+    procs = []
+    target = args.target
+    try:
+        if not target:
+            fakes_url = f"http://127.0.0.1:{args.fakes_port}"
+            procs.append(subprocess.Popen([
+                sys.executable, "-m", "bench.fakes", "--port", str(args.fakes_port),
+                "--latency-scale", str(args.latency_scale), "--openrouter-429", str(args.openrouter_429),
+            ], cwd=ROOT))
+            await _wait_ready(f"{fakes_url}/rest/v1/question_bank")
+            procs.append(subprocess.Popen([
+                sys.executable, "-m", "bench.serve_app", "--port", str(args.app_port), "--fakes", fakes_url,
+            ], cwd=ROOT))
+            target = f"http://127.0.0.1:{args.app_port}"
+            await _wait_ready(f"{target}/")
+
+        names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as client:
+            for name in names:
+                rec = Recorder()
+                start = time.perf_counter()
+                await SCENARIOS[name](client, target, rec, args)
+                rec.report(name, time.perf_counter() - start)
+    finally:
+        for p in procs:
+            p.terminate()
+            p.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="all")
+    parser.add_argument("--target", default="", help="URL de una app ya levantada (omite los servicios simulados)")
+    parser.add_argument("--students", type=int, default=30)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--think", type=float, default=0.5, help="pausa máxima entre turnos (s)")
+    parser.add_argument("--concurrency", type=int, default=20, help="exámenes simultáneos")
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--openrouter-429", type=float, default=0.0)
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--fakes-port", type=int, default=9100)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,65 @@
+"""
+Arranca app.py apuntando a los servicios simulados de bench.fakes.
+
+    python -m bench.serve_app --port 9000 --fakes http://127.0.0.1:9100
+
+edge-tts no permite cambiar su endpoint, así que se reemplaza
+edge_tts.Communicate por un cliente del TTS simulado con la misma interfaz
+(save() y stream()). Los límites de rate limit se elevan porque toda la carga
+sale de 127.0.0.1.
+"""
+import argparse
+import logging
+import os
+import sys
+
+import aiohttp
+
+def configure_env(fakes_url: str):
+    os.environ["OPENROUTER_API_KEY"] = "bench"
+    os.environ["DEEPGRAM_API_KEY"] = "bench"
+    os.environ["OPENROUTER_URL"] = f"{fakes_url}/api/v1/chat/completions"
+    os.environ["DEEPGRAM_URL"] = f"{fakes_url}/v1/listen?model=nova-2&smart_format=true&language=es"
+    os.environ["DEEPGRAM_LIVE_URL"] = f"{fakes_url.replace('http', 'ws', 1)}/v1/listen?model=nova-2&interim_results=true"
+    os.environ["VITE_SUPABASE_URL"] = fakes_url
+    os.environ["SUPABASE_SERVICE_ROLE_KEY"] = "bench"
+    os.environ.setdefault("ENVIRONMENT", "development")
+    for name in ("RATE_CHAT", "RATE_LISTEN", "RATE_TALK", "RATE_INIT", "RATE_EXAM", "RATE_VOICE", "RATE_GENERAL"):
+        os.environ.setdefault(name, "1000000")
+
+class FakeCommunicate:
+    """Sustituto de edge_tts.Communicate que sintetiza contra el TTS simulado."""
+    url = ""
+
+    def __init__(self, text: str, voice: str):
+        self.text = text
+        self.voice = voice
+
+    async def stream(self):
+        async with aiohttp.ClientSession() as client:
+            async with client.post(self.url, json={"text": self.text, "voice": self.voice}) as resp:
+                async for data in resp.content.iter_chunked(4096):
+                    yield {"type": "audio", "data": data}
+
+    async def save(self, path: str):
+        with open(path, "wb") as f:
+            async for chunk in self.stream():
+                f.write(chunk["data"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--fakes", default="http://127.0.0.1:9100")
+    args = parser.parse_args()
+
+    configure_env(args.fakes)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import edge_tts
+    import uvicorn
+
+    FakeCommunicate.url = f"{args.fakes}/tts"
+    edge_tts.Communicate = FakeCommunicate
+
+    import app
+    logging.getLogger().setLevel(logging.WARNING)
+    uvicorn.run(app.app, host="127.0.0.1", port=args.port, log_level="warning")